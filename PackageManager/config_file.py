@@ -1,6 +1,5 @@
 import tomllib as tml
 import tomli_w as tw
-import json
 
 class PyProject:
     def __init__(self, path):
@@ -1,13 +1,16 @@
 import argparse
 import importlib.metadata as metadata
 import sys
-import virtualenv
 import subprocess as sp
 import os
 from typing import List
-import re
+import glob
+import functools
+import tempfile
+import io
+import contextlib
 
-from .config_file import PyProject
+# venv, .config_file and packaging are imported by the functions that need them, so commands that don't need them stay fast
 
 try:
     VERSION = metadata.version("PackageManager")
@@ -23,17 +26,106 @@ else:
 PROG_NAME = sys.argv[0]
 
 GLOBAL_PYTHON_EXECUTABLE = sys.executable #path to the python executable
-GLOBAL_PIP_EXECUTABLE = f"{GLOBAL_PYTHON_EXECUTABLE} -m pip" #path to the pip executable
+GLOBAL_PIP = [GLOBAL_PYTHON_EXECUTABLE, "-m", "pip"] #command to run the global pip
 
 DEFAULT_CONFIG_PATH = "pyproject.toml" #a file with the same structure as a pyproject.toml file
 
+@functools.cache #Requires-Dist entries repeat across missing dependencies checks
+def parseRequirement(requirement : str):
+    from packaging.requirements import Requirement
+    return Requirement(requirement)
+
+def getCanonicalName(requirement : str) -> str:
+    from packaging.requirements import InvalidRequirement
+    from packaging.utils import canonicalize_name
+    
+    try:
+        return canonicalize_name(parseRequirement(requirement).name)
+    except InvalidRequirement:
+        return requirement
+
+def isPlainPin(requirement : str) -> bool:
+    # "name==version", without extras, marker, url or other specifiers
+    from packaging.requirements import InvalidRequirement
+    
+    try:
+        req = parseRequirement(requirement)
+    except InvalidRequirement:
+        return False
+    specifiers = list(req.specifier)
+    return not req.extras and req.marker is None and req.url is None and len(specifiers) == 1 and specifiers[0].operator == "=="
+
+
+def _run(cmd : List[str], parse_stdout : bool = False, input : str = None) -> sp.CompletedProcess:
+    if not parse_stdout:
+        # let the output go straight to the terminal, nothing is buffered
+        return sp.run(cmd, input=input, text=True)
+    
+    stdin = sp.PIPE if input is not None else None
+    with sp.Popen(cmd, stdin=stdin, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=64*1024, text=True) as proc:
+        stdout, stderr = proc.communicate(input)
+    return sp.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+def _runGlobalPip(args : List[str]) -> sp.CompletedProcess:
+    # GLOBAL_PIP runs on this interpreter, so pip can be called in-process to skip its startup;
+    # pip only guarantees its CLI, so fall back to a subprocess if its entry point can't be imported
+    try:
+        from pip._internal.cli.main import main as pipMain
+    except ImportError:
+        return _run([*GLOBAL_PIP, *args], parse_stdout=True)
+    import logging
+    import traceback
+    
+    # pip installs its own handlers on the root logger, bound to the redirected streams
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    stdout, stderr = io.StringIO(), io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            returncode = pipMain(list(args))
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        # an error part way through an install is reported, not retried
+        stderr.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        root.handlers[:] = handlers
+        root.setLevel(level)
+    return sp.CompletedProcess([*GLOBAL_PIP, *args], returncode, stdout.getvalue(), stderr.getvalue())
+
 
 class PackageManager:
     def __init__(self, config_path : str):
         self.configPath = config_path
         self.envPath = ".ppm.env"
+        self._bin = os.path.join(self.envPath, BIN_FOLDER)
+        self._venvPython = os.path.join(self._bin, "python")
+        self._venvPip = [self._venvPython, "-m", "pip"] #command to run the venv pip
+        self._installedCache : dict[bool, dict[str, str]] = {} #canonical name -> version of installed packages, keyed on _global
+    
+    @functools.cached_property
+    def config(self):
+        from .config_file import PyProject
+        return PyProject(self.configPath)
+    
+    @functools.cached_property
+    def dependencies(self) -> dict[str, List[str]]:
+        # canonical name -> requirement strings (e.g. "requests" -> ["requests==2.26.0"]), written back by saveConfig;
+        # a project can have several entries, e.g. with different markers
+        dependencies = {}
+        for dep in self.config["project"]["dependencies"]:
+            dependencies.setdefault(getCanonicalName(dep), []).append(dep)
+        return dependencies
+    
+    def saveConfig(self):
+        self.config["project"]["dependencies"] = [dep for _, entries in sorted(self.dependencies.items()) for dep in entries]
+        self.config.save()
         
     def createPyProject(self, name : str, authors : str, description : str):
+            from .config_file import PyProject
+            
             if not name:
                 name = input("Enter the name of the package: ")
             if not authors:
@@ -53,9 +145,27 @@ class PackageManager:
                 })
             
             config.save()
+            self.config = config
     
     def createVenv(self):
-        virtualenv.cli_run([self.envPath])
+        import venv
+        
+        # symlinking the interpreter avoids copying it, except on Windows where symlinks need privileges
+        builder = venv.EnvBuilder(with_pip=True, symlinks=(os.name != "nt"))
+        builder.create(self.envPath)
+        
+    def getSitePackages(self) -> List[str]:
+        if sys.platform == "win32":
+            return glob.glob(os.path.join(self.envPath, "Lib", "site-packages"))
+        return glob.glob(os.path.join(self.envPath, "lib", "python*", "site-packages"))
+    
+    def getDistributions(self, _global : bool):
+        if _global:
+            distributions = metadata.distributions()
+        else:
+            distributions = metadata.distributions(path=self.getSitePackages())
+        # an interrupted install can leave a .dist-info without METADATA, pip skips those too
+        return (dist for dist in distributions if (dist.metadata or {}).get("Name"))
         
     
     def init(self, name : str, authors : str, description : str) -> int:      
@@ -70,89 +180,150 @@ class PackageManager:
         return 0
             
     def install(self, names : List[str], _global : bool) -> int:
-        config = PyProject(self.configPath)
+        from packaging.requirements import InvalidRequirement
+        from packaging.utils import canonicalize_name
+        from packaging.version import InvalidVersion
+        
+        # load the config first, so a missing or invalid one is reported before creating the venv
+        self.config
         
         if not os.path.exists(self.envPath):
             self.createVenv()
         
         def getInstalledPackages():
-            if _global:
-                res = sp.run([GLOBAL_PIP_EXECUTABLE, "freeze"], capture_output=True)
-            else:
-                res = sp.run([f"{self.envPath}/{BIN_FOLDER}/pip", "freeze"], capture_output=True)
+            if _global not in self._installedCache:
+                self._installedCache[_global] = {canonicalize_name(dist.metadata["Name"]): dist.version for dist in self.getDistributions(_global)}
+            return self._installedCache[_global]
+        
+        def isInstalled(dep : str):
+            try:
+                req = parseRequirement(dep)
+            except InvalidRequirement:
+                return False # urls, paths, ... are left to pip
+            installed = getInstalledPackages()
+            name = canonicalize_name(req.name)
+            try:
+                return name in installed and req.specifier.contains(installed[name], prereleases=True)
+            except InvalidVersion:
+                return False # a non PEP 440 installed version (e.g. 1.0ubuntu1) can't be compared, pip decides
+        
+        def installPackages(packages : List[str], noDeps : bool = False, asRequirements : bool = False):
+            if not packages:
+                return 0
             
-            if res.returncode != 0:
-                raise Exception("Failed to get installed packages (exit code: {res.returncode})")
+            def runPip(args : List[str]):
+                if _global:
+                    return _runGlobalPip(args)
+                return _run([*self._venvPip, *args], parse_stdout=True)
             
-            return res.stdout.decode().split("\n")
-        
-        def installPackage(package : str, version : str = None, installDeps : bool = True):
-            if version:
-                package = f"{package}=={version}"
-            if _global:
-                cmd = [GLOBAL_PIP_EXECUTABLE, "install", package]
-                if installDeps:
-                    cmd.append("--no-deps")
-                res = sp.run(cmd, capture_output=True)
-                print(res.stderr.decode())
-                if res.returncode != 0:
-                    print(res.stderr.decode())
-                    return res.returncode
+            args = ["install"]
+            if noDeps:
+                args.append("--no-deps")
+            
+            if not asRequirements:
+                res = runPip([*args, *packages])
+            elif sys.platform == "win32" or _global:
+                # /dev/stdin is not available on Windows, and the in-process global pip would read our own stdin
+                with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+                    f.write("\n".join(packages))
+                try:
+                    res = runPip([*args, "-r", f.name])
+                finally:
+                    os.remove(f.name)
             else:
-                cmd = [f"{self.envPath}/{BIN_FOLDER}/pip", "install", package]
-                if installDeps:
-                    cmd.append("--no-deps")
-                res = sp.run(cmd, capture_output=True)
-                if res.returncode != 0:
-                    print(res.stderr.decode())
-                    return res.returncode
-                
-                stdout = res.stdout.decode()
-                
-                for line in stdout.split("\n"):
-                    if line.startswith("Successfully installed"):
-                        packages = line.split(" ")[2:]
-                        for package in packages:
-                            name, version = package.rsplit("-", 1)
-                            versionString = f"{name}=={version}"
-                            if versionString not in config["project"]["dependencies"]:
-                                config["project"]["dependencies"].append(versionString)
-                            print(f"Installed {name}=={version}")
-                config.save()
-                return 0
+                res = _run([*self._venvPip, *args, "-r", "/dev/stdin"], parse_stdout=True, input="\n".join(packages))
+            if res.returncode != 0:
+                print(res.stderr)
+                return res.returncode
+            
+            stdout = res.stdout
+            
+            # pip prints the summary last, no need to scan every line
+            idx = stdout.rfind("Successfully installed ")
+            if idx >= 0:
+                end = stdout.find("\n", idx)
+                line = stdout[idx:end if end >= 0 else len(stdout)].strip()
+                for package in line.split(" ")[2:]:
+                    name, version = package.rsplit("-", 1) #pip prints name-version, and normalized versions contain no "-"
+                    canonicalName = canonicalize_name(name)
+                    versionString = f"{name}=={version}"
+                    getInstalledPackages()[canonicalName] = version
+                    if _global:
+                        continue
+                    # an upgrade replaces plain pins, anything the user wrote by hand (extras, markers, ranges) is kept
+                    entries = self.dependencies.setdefault(canonicalName, [])
+                    if not entries:
+                        entries.append(versionString)
+                    else:
+                        updated = []
+                        for dep in entries:
+                            if isPlainPin(dep):
+                                if versionString in updated:
+                                    continue # several plain pins all become the same one
+                                dep = versionString
+                            updated.append(dep)
+                        entries[:] = updated
+                    print(f"Installed {name}=={version}")
+            return 0
         
         def getMissingDependencies():
-            cmd = [f"{self.envPath}/{BIN_FOLDER}/pip", "check"]
-            res = sp.run(cmd, capture_output=True)
-            if res.returncode != 0:
-                raise Exception("Failed to check for missing dependencies")
-            missingDeps = re.findall(r"requires (.+?),", res.stdout.decode())
+            distributions = list(self.getDistributions(_global))
+            installed = {canonicalize_name(dist.metadata["Name"]): dist.version for dist in distributions}
+            missingDeps = []
+            for dist in distributions:
+                distMissing = []
+                try:
+                    for requirement in dist.requires or []:
+                        req = parseRequirement(requirement)
+                        if req.marker and not req.marker.evaluate({"extra": ""}):
+                            continue
+                        name = canonicalize_name(req.name)
+                        if name in installed and req.specifier.contains(installed[name], prereleases=True):
+                            continue
+                        distMissing.append(f"{req.name}{req.specifier}")
+                except (InvalidRequirement, InvalidVersion) as e:
+                    # legacy metadata or non PEP 440 versions, as pip check does, warn and move on
+                    print(f"WARNING: Ignoring the requirements of {dist.metadata['Name']} {dist.version}: {e}")
+                    continue
+                for dep in distMissing:
+                    if dep not in missingDeps:
+                        missingDeps.append(dep)
             return missingDeps
             
             
-        installedPackages = getInstalledPackages()
+        toInstall = []
         if not names:
             # install all dependencies in the config file
-            deps = config["project"]["dependencies"]
+            deps = [dep for entries in self.dependencies.values() for dep in entries]
             
             print(f"Installing {len(deps)} dependencies")
             for dep in deps:
-                if dep not in installedPackages:
-                    installPackage(dep, installDeps=False)
+                if not isInstalled(dep):
+                    toInstall.append(dep)
                 else:
                     print(f"Dependency {dep} is already installed")
         else:
             for package in names:
-                if package not in installedPackages:
-                    installPackage(package, installDeps=False)
+                if not isInstalled(package):
+                    toInstall.append(package)
                 else:
                     print(f"Package {package} is already installed")
-                    
-        missingDeps = getMissingDependencies()
-        for dep in missingDeps:
-            self.install([dep], _global)
-                
-        return 0
+        try:
+            res = installPackages(toInstall, asRequirements=not names)
+            
+            # resolve missing dependencies iteratively, reusing the installed packages cache and the config
+            attempted = set(toInstall)
+            while res == 0:
+                missingDeps = [dep for dep in getMissingDependencies() if dep not in attempted]
+                if not missingDeps:
+                    break
+                res = installPackages(missingDeps)
+                attempted.update(missingDeps)
+        finally:
+            # write what was installed even if a later install failed or raised
+            if not _global:
+                self.saveConfig()
+        return res
             
     def uninstall(self, names : List[str], _global : bool) -> int:
         """Uninstall a package
@@ -168,62 +339,60 @@ class PackageManager:
             print("No environment found")
             return 1
         
-        config = PyProject(self.configPath)
+        from packaging.requirements import InvalidRequirement
         
         if _global:
-            res = sp.run([GLOBAL_PIP_EXECUTABLE, "uninstall", "-y", *names], capture_output=True)
-            return res.returncode
+            return _run([*GLOBAL_PIP, "uninstall", "-y", *names]).returncode
         else:
             # find the package in the config file
-            deps = config["project"]["dependencies"] #are of form "requests==2.26.0"
             #name in names can be of form "requests" or "requests==2.26.0"
+            def matches(dep : str, name : str):
+                if "==" not in name:
+                    return True
+                try:
+                    return parseRequirement(dep).specifier == parseRequirement(name).specifier
+                except InvalidRequirement:
+                    return dep == name
+            
+            toUninstall = []
             for name in names:
-                version = ""
-                if "==" in name:
-                    if name in deps:
-                        deps.remove(name)
-                        version = name.split("==")[1]
-                    else:
-                        print(f"Package {name} not found in dependencies")
-                        continue
-                else:
-                    for dep in deps:
-                        if dep.split("==")[0] == name:
-                            version = dep.split("==")[1]
-                            deps.remove(dep)
-                            break
-                    else:
-                        print(f"Package {name} not found in dependencies")
-                        continue
+                canonicalName = getCanonicalName(name)
+                entries = self.dependencies.get(canonicalName, [])
+                removed = [dep for dep in entries if matches(dep, name)]
+                if not removed:
+                    print(f"Package {name} not found in dependencies")
+                    continue
+                # only the matching entries go, other entries of the same project stay
+                self.dependencies[canonicalName] = [dep for dep in entries if dep not in removed]
+                if not self.dependencies[canonicalName]:
+                    del self.dependencies[canonicalName]
+                toUninstall.extend(removed)
+            
+            if toUninstall:
                 try:
-                    res = sp.run([f"{self.envPath}/{BIN_FOLDER}/pip", "uninstall", "-y", f"{name}=={version}"], capture_output=True)
+                    res = _run([*self._venvPip, "uninstall", "-y", *toUninstall])
                     if res.returncode != 0:
-                        print(res.stderr.decode())
                         return res.returncode
                 except Exception as e:
                     print(e)
-                    print(os.path.abspath(f"{self.envPath}/{BIN_FOLDER}/pip"))
+                    print(os.path.abspath(self._venvPython))
                 
-                print(f"Uninstalled {name}=={version}")
-            config.save()
+                for package in toUninstall:
+                    print(f"Uninstalled {package}")
+                self.saveConfig()
             return 0
             
     def list(self, _global : bool, deprecated : bool) -> int:
-        cmd = "list"
+        if not _global and not os.path.exists(self.envPath):
+            print("No environment found")
+            return 1
+        
+        cmd = [*(GLOBAL_PIP if _global else self._venvPip), "list"]
         if deprecated:
-            cmd += " --outdated"
+            cmd.append("--outdated")
         
-        if _global:
-            res = sp.run(f"{GLOBAL_PIP_EXECUTABLE} {cmd}", shell=True)
-            if res.returncode != 0:
-                print(res.stderr.decode())
-                return res.returncode
-        else:
-            res = sp.run(f"{self.envPath}/{BIN_FOLDER}/pip {cmd}", shell=True)
-            if res.returncode != 0:
-                print(res.stderr.decode())
-                return res.returncode
-        return 0
+        # pip writes straight to the terminal, errors included
+        return sp.run(cmd, check=False).returncode
     
     def run(self, script : str, args : List[str]) -> int:
         if not os.path.exists(script):
@@ -233,14 +402,14 @@ class PackageManager:
         if not os.path.exists(self.envPath):
             self.createVenv()
         
-        res = sp.run([f"{self.envPath}/{BIN_FOLDER}/python", script, *args])
+        res = sp.run([self._venvPython, script, *args])
         return res.returncode
     
     def cli(self, _global : bool) -> int:
         if _global:
             res = sp.run(GLOBAL_PYTHON_EXECUTABLE)
         else:
-            res = sp.run(f"{self.envPath}/{BIN_FOLDER}/python")
+            res = sp.run(self._venvPython)
         return res.returncode
     
 class ConfigArgParser:
@@ -281,32 +450,31 @@ class ConfigArgParser:
         cliParser.add_argument("--global", action="store_true", help="Open a Python shell in the global environment", default=False, dest="_global")
 
 
+COMMANDS = { #command name -> (argument parser registration, handler)
+    "init": (ConfigArgParser.init, lambda pm, args: pm.init(args.name, args.authors, args.description)),
+    "install": (ConfigArgParser.install, lambda pm, args: pm.install(args.name, args._global)),
+    "uninstall": (ConfigArgParser.uninstall, lambda pm, args: pm.uninstall(args.name, args._global)),
+    "list": (ConfigArgParser.list, lambda pm, args: pm.list(args._global, args.deprecated)),
+    "run": (ConfigArgParser.run, lambda pm, args: pm.run(args.script, args.args)),
+    "cli": (ConfigArgParser.cli, lambda pm, args: pm.cli(args._global)),
+}
+
+
 def main():
     parser = argparse.ArgumentParser(PROG_NAME, description="A package manager similar to npm, but for Python")
     parser.add_argument("--version", action="version", version=VERSION)
     parser.add_argument("-c", "--config", help="Path to the pyproject.toml file", default=DEFAULT_CONFIG_PATH)
     commandParser = parser.add_subparsers(dest="command")
     
-    for func in ConfigArgParser.__dict__.values():
-        if callable(func):
-            func(commandParser)
+    for register, _ in COMMANDS.values():
+        register(commandParser)
     
     args = parser.parse_args()
     
-    pm = PackageManager(args.config)
-    if args.command == "init":
-        return pm.init(args.name, args.authors, args.description)
-    elif args.command == "install":
-        return pm.install(args.name, args._global)
-    elif args.command == "uninstall":
-        return pm.uninstall(args.name, args._global)
-    elif args.command == "list":
-        return pm.list(args._global, args.deprecated)
-    elif args.command == "run":
-        return pm.run(args.script, args.args)
-    elif args.command == "cli":
-        return pm.cli(args._global)
-    else:
+    if args.command not in COMMANDS:
         print("No command specified")
         parser.print_help()
         sys.exit(1)
+    
+    pm = PackageManager(args.config)
+    return COMMANDS[args.command][1](pm, args)